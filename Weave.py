@@ -1,8 +1,26 @@
-from typing import Optional
+import asyncio
+import json
+import re
+import threading
+import time
+from concurrent.futures import Future
+from typing import NamedTuple, Optional
+import msgspec
+import orjson
 import streamlit as st
 from google import genai
-from google.genai import types
-from pydantic import BaseModel, Field, ConfigDict
+from google.genai import errors, types
+from response_schema import ResponseSchema, decode_response
+
+# The SDK (de)serializes request bodies and streamed chunks through its module level json import,
+# orjson handles those plain dumps/loads calls much faster. Skip the patch if the SDK internals change.
+try:
+    from google.genai import _api_client as genai_api_client
+except ImportError:
+    pass
+else:
+    if getattr(genai_api_client, "json", None) is json:
+        genai_api_client.json = orjson
 
 st.set_page_config(
     page_title="Weave",
@@ -22,64 +40,31 @@ with st.sidebar:
         st.session_state.gemini_api_key = gemini_api_key
     else:
         st.session_state.gemini_api_key = None
+    fast_mode = st.toggle(
+        "Fast mode",
+        help="Disable model thinking for faster responses on simple templates.",
+    )
+    parallel_requests = st.toggle(
+        "Parallel requests",
+        help="Send one request per output format concurrently instead of a single batched request.",
+    )
 
 # AI Setup
-class ResponseSchema(BaseModel):
-    type: str = Field(..., description="Type of the response, either 'code' or 'text'.")
-    message: Optional[str] = Field(None, description="Message from the AI.")
-    code: Optional[str] = Field(None, description="Generated code if type is 'code'.")
-    changes: Optional[str] = Field(None, description="Description of changes made to the template.")
-    recommendations: Optional[str] = Field(None, description="Recommendations for further improvements.")
+_POLL_INTERVAL = 0.05
+_TRANSFORM_TTL = 3600
+_MAX_STORED_TRANSFORMS = 256
 
-    model_config = ConfigDict(from_attributes=True)
+# Prefill time grows linearly with the prompt, so refuse pathologically large templates.
+_MAX_TEMPLATE_LENGTH = 200_000
 
-def transform_html(output_format: str, template: str):
-    if not st.session_state.get("gemini_api_key"):
-        st.error("Please enter your Gemini API key in the sidebar.")
-        return
-    
-    client = genai.Client(
-        api_key=st.session_state.get("gemini_api_key")
-    )
+_WHITESPACE_PATTERN = re.compile(r"\s+")
+_PRESERVED_TAG_PATTERN = re.compile(r"<(pre|textarea|script)\b", re.IGNORECASE)
+_CLOSING_TAG_PATTERNS = {
+    tag: re.compile(rf"</{tag}\s*>", re.IGNORECASE)
+    for tag in ("pre", "textarea", "script")
+}
 
-    model = "gemini-2.5-flash-preview-05-20"
-    contents = [
-        types.Content(
-            role="user",
-            parts=[
-                types.Part.from_text(text=f"FORMAT: {output_format.lower()}\nTEMPLATE: {template}"),
-            ],
-        ),
-    ]
-    generate_content_config = types.GenerateContentConfig(
-        thinking_config = types.ThinkingConfig(
-            thinking_budget=2018,
-        ),
-        response_mime_type="application/json",
-        response_schema=genai.types.Schema(
-            type = genai.types.Type.OBJECT,
-            required = ["type"],
-            properties = {
-                "type": genai.types.Schema(
-                    type = genai.types.Type.STRING,
-                    enum = ["code", "text"],
-                ),
-                "message": genai.types.Schema(
-                    type = genai.types.Type.STRING,
-                ),
-                "code": genai.types.Schema(
-                    type = genai.types.Type.STRING,
-                ),
-                "changes": genai.types.Schema(
-                    type = genai.types.Type.STRING,
-                ),
-                "recommendations": genai.types.Schema(
-                    type = genai.types.Type.STRING,
-                ),
-            },
-        ),
-        system_instruction=[
-            types.Part.from_text(text="""You are **Weave**, an AI-powered front-end design assistant with deep expertise in **HTML**, **CSS**, **JavaScript**, **React**, **Vue**, **Flutter**, and **Tailwind CSS**.
+_SYSTEM_PROMPT_TEXT = """You are **Weave**, an AI-powered front-end design assistant with deep expertise in **HTML**, **CSS**, **JavaScript**, **React**, **Vue**, **Flutter**, and **Tailwind CSS**.
 
 ## Purpose  
 Your mission is to **analyze, improve, and transform** front-end UI templates according to modern **UI/UX design principles**, **responsive layout techniques**, and **framework-specific conventions** — including cross-platform support for **web** and **mobile** via **Flutter**.
@@ -101,7 +86,7 @@ Your mission is to **analyze, improve, and transform** front-end UI templates ac
 ## Input  
 You will receive:
 - A raw UI `TEMPLATE` written in **HTML**
-- A `FORMAT` directive specifying the desired output:
+- A `FORMATS` directive listing one or more comma separated desired outputs:
   - `\"html\"` → Return optimized HTML5 with Tailwind (or inline CSS)
   - `\"react\"` → Return a modular React functional component using JSX and Tailwind (or CSS Modules)
   - `\"vue\"` → Return a Vue 3 Single File Component with Tailwind and `<script setup>`
@@ -118,8 +103,9 @@ If the UI contains **repeating patterns**, **visually distinct sections**, or **
 - Separate layout structure and styling concerns where applicable (e.g., use `Container`, `Padding`, `Column`, etc. in Flutter)
 
 ## Output Rules
-- Return **only** the code in the specified format (`html`, `react`, `vue`, or `flutter`)
+- Return **only** the code in the specified formats (`html`, `react`, `vue`, or `flutter`)
 - All of your responses must be formatted in a common json schema
+  - The response is a json array with one entry per requested FORMAT, each tagged with its format in the `format` key (value type string).
   - Every message must have a type key that will indicate if it's ui related or normal text. It will have two values `code` and `text` and it will the in the `type` key (value type string).
   - If the type is `code` then it must have these kv pairs otherwise null or completely ommit these fields.
     - The output json will have the updated code in the `code` key (value type string).
@@ -131,28 +117,375 @@ If the UI contains **repeating patterns**, **visually distinct sections**, or **
 
 ## Behavior
 Inputs will follow this structure for template improvements:
-FORMAT: <html|react|vue|flutter>
+FORMATS: <comma separated list of html|react|vue|flutter>
 TEMPLATE: <HTML snippet needing improvement>
 
-Your job is to output the **final, cleaned, modular, and responsive** version in the specified format — honoring platform conventions, user experience best practices, and maintainability.
+Your job is to output the **final, cleaned, modular, and responsive** version in each of the specified formats — honoring platform conventions, user experience best practices, and maintainability.
 
 **NOTE**: If the input does not follow the specified structure then the user might want to update your last outputted design. The first message will always follow the structure if it don't then don't ask the user to follow the structure but process user query normally.
 **Your response must be only the json output as text do not format the output as markdown code block**
-**You must not process any requests other than your core capabilities or greetings**"""),
-        ],
+**You must not process any requests other than your core capabilities or greetings**"""
+
+@st.cache_resource
+def get_genai_client(api_key: str) -> genai.Client:
+    return genai.Client(api_key=api_key)
+
+@st.cache_resource
+def get_system_instruction() -> list[types.Part]:
+    return [types.Part.from_text(text=_SYSTEM_PROMPT_TEXT)]
+
+# One long lived loop keeps the async client's pooled connections usable across transforms.
+@st.cache_resource
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="weave-event-loop", daemon=True).start()
+    return loop
+
+@st.cache_resource
+def get_response_schema() -> types.Schema:
+    return genai.types.Schema(
+        type = genai.types.Type.ARRAY,
+        items = genai.types.Schema(
+            type = genai.types.Type.OBJECT,
+            required = ["format", "type"],
+            properties = {
+                "format": genai.types.Schema(
+                    type = genai.types.Type.STRING,
+                    enum = ["html", "react", "vue", "flutter"],
+                ),
+                "type": genai.types.Schema(
+                    type = genai.types.Type.STRING,
+                    enum = ["code", "text"],
+                ),
+                "message": genai.types.Schema(
+                    type = genai.types.Type.STRING,
+                ),
+                "code": genai.types.Schema(
+                    type = genai.types.Type.STRING,
+                ),
+                "changes": genai.types.Schema(
+                    type = genai.types.Type.STRING,
+                ),
+                "recommendations": genai.types.Schema(
+                    type = genai.types.Type.STRING,
+                ),
+            },
+        ),
+    )
+
+@st.cache_resource(max_entries=64)
+def get_generate_content_config(
+    cached_content: Optional[str] = None,
+    thinking_budget: int = 2018,
+) -> types.GenerateContentConfig:
+    if cached_content:
+        return get_generate_content_config(thinking_budget=thinking_budget).model_copy(
+            update={
+                "system_instruction": None,
+                "cached_content": cached_content,
+            },
+        )
+    return types.GenerateContentConfig(
+        thinking_config = types.ThinkingConfig(
+            thinking_budget=thinking_budget,
+        ),
+        response_mime_type="application/json",
+        response_schema=get_response_schema(),
+        system_instruction=get_system_instruction(),
+    )
+
+# Shared by every session using the same key, so each key pays for one server side cache at a time.
+# Errors propagate so that a transient failure isn't cached for the whole hour.
+@st.cache_resource(ttl=3600, show_spinner=False)
+def get_cached_content(api_key: str, model: str) -> str:
+    cached_content = get_genai_client(api_key).caches.create(
+        model=model,
+        config=types.CreateCachedContentConfig(
+            system_instruction=get_system_instruction(),
+            ttl="3600s",
+        ),
     )
+    return cached_content.name
+
+def lookup_cached_content(api_key: str, model: str) -> Optional[str]:
+    try:
+        return get_cached_content(api_key, model)
+    except errors.APIError:
+        # Caching is only an optimization, fall back to sending the instruction inline.
+        return None
+
+def refresh_cached_content(api_key: str, model: str, expired: str) -> Optional[str]:
+    # Only recreate the cache if no other request has replaced the expired one already.
+    if lookup_cached_content(api_key, model) == expired:
+        get_cached_content.clear(api_key, model)
+    return lookup_cached_content(api_key, model)
+
+def refresh_generate_content_config(
+    api_key: str,
+    model: str,
+    expired: str,
+    thinking_budget: int,
+) -> types.GenerateContentConfig:
+    cached_content = refresh_cached_content(api_key, model, expired)
+    return get_generate_content_config(cached_content, thinking_budget)
 
-    generated_content = client.models.generate_content(
+async def open_stream(
+    client: genai.Client,
+    model: str,
+    contents: list[types.Content],
+    config: types.GenerateContentConfig,
+):
+    stream = await client.aio.models.generate_content_stream(
         model=model,
         contents=contents,
-        config=generate_content_config,
+        config=config,
     )
+    return stream, await anext(stream, None)
+
+async def stream_transform(
+    client: genai.Client,
+    api_key: str,
+    model: str,
+    output_formats: tuple[str, ...],
+    template: str,
+    config: types.GenerateContentConfig,
+    thinking_budget: int,
+    buffers: list[str],
+    index: int,
+) -> str:
+    contents = [
+        types.Content(
+            role="user",
+            parts=[
+                types.Part.from_text(text=f"FORMATS: {', '.join(output_formats)}\nTEMPLATE: {template}"),
+            ],
+        ),
+    ]
     try:
-        validated_response = ResponseSchema.model_validate_json(generated_content.text)
-    except Exception as e:
-        st.error(f"Error in response schema validation: {e}")
+        stream, chunk = await open_stream(client, model, contents, config)
+    except errors.ClientError as e:
+        # The cache expired or was deleted, recreate it and retry once.
+        if not config.cached_content or e.code not in (403, 404):
+            raise
+        # Creating the cache blocks, keep it off the loop that every session streams on.
+        config = await asyncio.to_thread(
+            refresh_generate_content_config,
+            api_key,
+            model,
+            config.cached_content,
+            thinking_budget,
+        )
+        stream, chunk = await open_stream(client, model, contents, config)
+    while chunk is not None:
+        if chunk.text:
+            # The script thread polls the buffers and renders them, this thread never touches the UI.
+            buffers[index] += chunk.text
+        chunk = await anext(stream, None)
+    return buffers[index]
+
+async def stream_transforms(
+    client: genai.Client,
+    api_key: str,
+    model: str,
+    requests: list[tuple[str, ...]],
+    template: str,
+    config: types.GenerateContentConfig,
+    thinking_budget: int,
+    buffers: list[str],
+) -> list[str]:
+    try:
+        # Unlike gather, a task group cancels the remaining requests as soon as one of them fails.
+        async with asyncio.TaskGroup() as group:
+            tasks = [
+                group.create_task(stream_transform(
+                    client,
+                    api_key,
+                    model,
+                    output_formats,
+                    template,
+                    config,
+                    thinking_budget,
+                    buffers,
+                    index,
+                ))
+                for index, output_formats in enumerate(requests)
+            ]
+    except ExceptionGroup as e:
+        raise e.exceptions[0]
+    return [task.result() for task in tasks]
+
+# Only the raw buffers of finished transforms are kept, plain strings stay valid whichever
+# __main__ is current. A plain store instead of st.cache_data, which would record the
+# progress elements and replay them on every hit.
+@st.cache_resource
+def get_transform_store() -> dict[tuple, tuple[float, list[str]]]:
+    return {}
+
+def lookup_transform(key: tuple) -> Optional[list[str]]:
+    stored = get_transform_store().get(key)
+    if stored is None or time.monotonic() - stored[0] > _TRANSFORM_TTL:
         return None
-    return validated_response
+    return stored[1]
+
+def store_transform(key: tuple, buffers: list[str]):
+    store = get_transform_store()
+    store[key] = (time.monotonic(), buffers)
+    # Dicts keep insertion order, so the oldest entries come first.
+    for stale in list(store)[:-_MAX_STORED_TRANSFORMS]:
+        store.pop(stale, None)
+
+# Lives in session state so that reruns from other widgets re-attach to the transform
+# instead of aborting it.
+class PendingTransform(NamedTuple):
+    key: tuple
+    output_formats: tuple[str, ...]
+    parallel: bool
+    future: Future
+    buffers: list[str]
+    started: float
+    stored: bool
+
+def start_transform(
+    api_key: str,
+    output_formats: tuple[str, ...],
+    template: str,
+    thinking_budget: int,
+    parallel: bool,
+    running: Optional[PendingTransform],
+) -> PendingTransform:
+    formats = tuple(output_format.lower() for output_format in output_formats)
+    key = (api_key, formats, template, thinking_budget, parallel)
+    if running is not None and running.key == key:
+        # Clicking Transform again for the same request keeps waiting on the one in flight.
+        return running
+    future = Future()
+    if (buffers := lookup_transform(key)) is not None:
+        future.set_result(buffers)
+    else:
+        model = "gemini-2.5-flash-preview-05-20"
+        # Resolve the cached resources here, the loop thread has no script context to report them to.
+        client = get_genai_client(api_key)
+        config = get_generate_content_config(lookup_cached_content(api_key, model), thinking_budget)
+        requests = [(output_format,) for output_format in formats] if parallel else [formats]
+        buffers = [""] * len(requests)
+        # Stream on the loop thread so this thread stays free to notice reruns, e.g. from the Cancel button.
+        future = asyncio.run_coroutine_threadsafe(
+            stream_transforms(
+                client,
+                api_key,
+                model,
+                requests,
+                template,
+                config,
+                thinking_budget,
+                buffers,
+            ),
+            get_event_loop(),
+        )
+    return PendingTransform(
+        key=key,
+        output_formats=output_formats,
+        parallel=parallel,
+        future=future,
+        buffers=buffers,
+        started=time.monotonic(),
+        stored=future.done(),
+    )
+
+def cancel_pending_transform():
+    if (pending := st.session_state.pop("pending", None)) is not None:
+        # Thread safe, and a no-op once the transform has finished.
+        pending.future.cancel()
+
+def watch_transform(pending: PendingTransform):
+    progress = st.empty()
+    with progress.container():
+        status = st.empty()
+        if pending.parallel:
+            placeholders = [tab.empty() for tab in st.tabs(list(pending.output_formats))]
+        else:
+            placeholders = [st.empty()]
+    shown = [""] * len(pending.buffers)
+    shown_elapsed = None
+    try:
+        while not pending.future.done():
+            for index, (placeholder, buffer) in enumerate(zip(placeholders, pending.buffers)):
+                if buffer != shown[index]:
+                    placeholder.code(buffer, language="json")
+                    shown[index] = buffer
+            # Streamlit only handles a pending rerun when this thread emits an element, so keep ticking.
+            elapsed = int(time.monotonic() - pending.started)
+            if elapsed != shown_elapsed:
+                status.caption(f"Waiting for Gemini... {elapsed}s")
+                shown_elapsed = elapsed
+            time.sleep(_POLL_INTERVAL)
+    finally:
+        progress.empty()
+
+def decode_buffers(buffers: list[str]) -> list[ResponseSchema]:
+    try:
+        return [output for buffer in buffers for output in decode_response(buffer)]
+    except msgspec.DecodeError as e:
+        raise ValueError(f"Error in response schema validation: {e}") from e
+
+def finish_transform(pending: PendingTransform) -> list[ResponseSchema]:
+    # A rerun interrupts the wait with pending still in session state, the next run picks it up again.
+    watch_transform(pending)
+    del st.session_state["pending"]
+    buffers = pending.future.result()
+    transformed_outputs = decode_buffers(buffers)
+    # Only keep responses that decode, so a broken one is requested again next time.
+    if not pending.stored:
+        store_transform(pending.key, buffers)
+    return transformed_outputs
+
+def normalize_template(template: str) -> str:
+    # Collapse indentation to cut prompt tokens, but keep blocks where whitespace is significant.
+    # Each block is matched as an opening tag followed by a search for its closing tag,
+    # which keeps this linear.
+    parts = []
+    position = search_from = 0
+    unclosed = set()
+    while opening := _PRESERVED_TAG_PATTERN.search(template, search_from):
+        tag = opening.group(1).lower()
+        search_from = opening.end()
+        if tag in unclosed:
+            continue
+        closing = _CLOSING_TAG_PATTERNS[tag].search(template, opening.end())
+        if closing is None:
+            # Nothing later closes this tag, so skip its remaining openings
+            # but keep looking for the others.
+            unclosed.add(tag)
+            continue
+        parts.append(_WHITESPACE_PATTERN.sub(" ", template[position:opening.start()]))
+        parts.append(template[opening.start():closing.end()])
+        position = search_from = closing.end()
+    parts.append(_WHITESPACE_PATTERN.sub(" ", template[position:]))
+    return "".join(parts).strip()
+
+def render_outputs(output_formats: tuple[str, ...], transformed_outputs: list[ResponseSchema]):
+    outputs_by_format = {output.format: output for output in transformed_outputs}
+    for output_format, tab in zip(output_formats, st.tabs(output_formats)):
+        with tab:
+            transformed_output = outputs_by_format.get(output_format.lower())
+            if transformed_output is None:
+                st.error(f"No {output_format} output was returned.")
+            elif transformed_output.type == "code":
+                lang = output_lang_map[output_format]
+                st.code(transformed_output.code, language=lang)
+                if transformed_output.changes:
+                    st.info(f"Changes made: {transformed_output.changes}")
+                if transformed_output.recommendations:
+                    st.warning(f"Recommendations: {transformed_output.recommendations}")
+            else:
+                st.text(transformed_output.message)
+
+def cancel_transform():
+    st.session_state["cancel"] = True
+    # Don't leave the previous result on screen as if it belonged to the cancelled transform.
+    st.session_state.pop("last_result", None)
+    # Only Cancel stops the request, any other rerun re-attaches to it.
+    cancel_pending_transform()
 
 st.title("Weave 🪡")
 
@@ -171,34 +504,59 @@ output_lang_map = {
     "Flutter": "dart"
 }
 
-output_format = st.pills(
+output_formats = st.pills(
     label="Output Format",
     options=output_lang_map.keys(),
+    selection_mode="multi",
     key="pills"
 )
 
+if st.session_state.pop("cancel", False):
+    st.info("Transformation cancelled.")
+
 if st.button("Transform"):
-    if not html_to_transform:
+    # Whatever happens next, the previous result no longer matches the latest request.
+    st.session_state.pop("last_result", None)
+    running = st.session_state.pop("pending", None)
+    api_key = st.session_state.gemini_api_key
+    # Check the raw input first, so oversized input is rejected without being normalized.
+    if len(html_to_transform) > _MAX_TEMPLATE_LENGTH:
+        st.error(f"Template too large, please keep it under {_MAX_TEMPLATE_LENGTH:,} characters.")
+    elif not (template := normalize_template(html_to_transform)):
         st.error("Please enter some HTML code to transform.")
-    elif not output_format:
-        st.error("Please select an output format.")
-    elif st.session_state.gemini_api_key is None:
+    elif not output_formats:
+        st.error("Please select at least one output format.")
+    elif api_key is None:
         st.error("Please enter your Gemini API key in the sidebar.")
     else:
-        with st.spinner("Transforming..."):
-            transformed_output = transform_html(
-                output_format=output_format.lower(),
-                template=html_to_transform
-            )
-            if transformed_output:
-                if transformed_output.type == "code":
-                    st.success("Transformation successful!")
-                    st.code(transformed_output.code, language=output_lang_map.get(output_format))
-                    if transformed_output.changes:
-                        st.info(f"Changes made: {transformed_output.changes}")
-                    if transformed_output.recommendations:
-                        st.warning(f"Recommendations: {transformed_output.recommendations}")
-                else:
-                    st.text(transformed_output.message)
-            else:
-                st.error("Failed to transform the HTML code.")
\ No newline at end of file
+        # Short templates rarely need deep reasoning and thinking tokens delay the first visible token.
+        thinking_budget = 0 if fast_mode else min(2018, max(128, len(template) // 4))
+        st.session_state["pending"] = start_transform(
+            api_key=api_key,
+            output_formats=tuple(output_formats),
+            template=template,
+            thinking_budget=thinking_budget,
+            parallel=parallel_requests,
+            running=running,
+        )
+    if running is not None and st.session_state.get("pending") is not running:
+        # Stop the previous request unless this click asked for the very same transform.
+        running.future.cancel()
+
+if (pending := st.session_state.get("pending")) is not None:
+    cancel_button = st.empty()
+    cancel_button.button("Cancel", on_click=cancel_transform)
+    try:
+        transformed_outputs = finish_transform(pending)
+    except Exception as e:
+        st.error(f"Failed to transform the HTML code: {e}")
+    else:
+        # Keep the result in session state so it survives reruns from other widgets,
+        # the success banner is only shown by the run that produced it.
+        st.session_state["last_result"] = (pending.output_formats, transformed_outputs)
+        st.success("Transformation successful!")
+    finally:
+        cancel_button.empty()
+
+if "last_result" in st.session_state:
+    render_outputs(*st.session_state["last_result"])
@@ -0,0 +1,19 @@
+from typing import Literal
+import msgspec
+
+# Kept out of Weave.py: Streamlit re-executes the main script as a fresh __main__ on every rerun,
+# while an imported module is loaded once, so the struct and its decoder are built once per process.
+
+# Only string fields, so instances can never be part of a reference cycle.
+class ResponseSchema(msgspec.Struct, gc=False):
+    format: str
+    type: Literal["code", "text"]
+    message: str | None = None
+    code: str | None = None
+    changes: str | None = None
+    recommendations: str | None = None
+
+_RESPONSE_DECODER = msgspec.json.Decoder(list[ResponseSchema])
+
+def decode_response(buffer: str) -> list[ResponseSchema]:
+    return _RESPONSE_DECODER.decode(buffer)